@@ -35,6 +35,7 @@ class DedicatedRemote:
         self.validHeaders = ["GBXRemote 2"]
 
         self.socket = None
+        self.socketlock = threading.Lock()
 
         self.connalive = False
         self.connalivelock = threading.RLock()
@@ -57,13 +58,38 @@ class DedicatedRemote:
         self._curr_handler = 0x80000000
         self._recv_loop_t = None
 
+    def __recv_exact(self, size, interruptible=False):
+        # recv may return only part of a packet, keep reading until complete.
+        # If interruptible, a timeout before the first byte is passed on so
+        # the caller can check if the connection is still alive.
+        chunks = []
+        remaining = size
+        while remaining > 0:
+            try:
+                chunk = self.socket.recv(remaining)
+            except socket.timeout:
+                if interruptible and not chunks:
+                    raise
+                with self.connalivelock:
+                    if not self.connalive:
+                        raise
+                continue
+
+            if not chunk:
+                raise ConnectionResetError("Connection closed by the remote.")
+
+            chunks.append(chunk)
+            remaining -= len(chunk)
+
+        return b"".join(chunks)
+
     def __recv_header(self):
         # get header length
-        hlendata = self.socket.recv(4)
+        hlendata = self.__recv_exact(4)
         hlen = struct.unpack("<I", hlendata)[0]
 
         # get header string
-        headerdata = self.socket.recv(hlen)
+        headerdata = self.__recv_exact(hlen)
         return headerdata.decode()
 
     def __build_packet(self, handler, method, args):
@@ -90,14 +116,16 @@ class DedicatedRemote:
             time.sleep(1)
 
     def _next_handler(self):
-        nexthandler = self._curr_handler
+        # concurrent callers must never share a handler id
+        with self.handlerslock:
+            nexthandler = self._curr_handler
 
-        if nexthandler == 0xFFFFFFFF:
-            self._curr_handler = 0x80000000
-        else:
-            self._curr_handler += 1
+            if nexthandler == 0xFFFFFFFF:
+                self._curr_handler = 0x80000000
+            else:
+                self._curr_handler += 1
 
-        return nexthandler
+            return nexthandler
 
     def _authenticate(self):
         success = self.call("Authenticate", self.username, self.password)
@@ -195,10 +223,10 @@ class DedicatedRemote:
 
             try:
                 # recieve packets
-                headerdata = self.socket.recv(8)
+                headerdata = self.__recv_exact(8, interruptible=True)
 
                 size, handler = struct.unpack("<IL", headerdata)
-                packetdata = self.socket.recv(size)
+                packetdata = self.__recv_exact(size)
 
                 data = None
                 method = None
@@ -321,20 +349,20 @@ class DedicatedRemote:
                     raise Exception("No connection to remote server.")
 
             # setup handler and send the packet
-            handler = self._next_handler()
             resultEvent = threading.Event()
             with self.handlerslock:
+                handler = self._next_handler()
                 self.handlers[handler] = {"event": resultEvent, "result": None}
 
             packet = self.__build_packet(handler, method, args)
-            # with self.socketlock:
-            self.socket.send(packet)
+            with self.socketlock:
+                self.socket.sendall(packet)
 
             # wait for result
             if not asynchronous:
                 if resultEvent.wait(self.resultTimeout):
                     with self.handlerslock:
-                        return self.handlers[handler]["result"]
+                        return self.handlers.pop(handler)["result"]
 
                 raise Exception("Failed to recieve data from XMLRPC call.")
 
@@ -1,17 +1,45 @@
-from threading import Thread, Event
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+from threading import Lock, Thread, Event
 from oauthlib.oauth2 import TokenExpiredError
 from oauthlib.oauth2.rfc6749.grant_types import refresh_token
 from requests_oauthlib import OAuth2Session
-from typing import Any, Callable, Concatenate, Literal, Optional, Self, cast
+from typing import Any, Callable, Concatenate, Iterator, Literal, Optional, Self, cast
 from xmlrpc.client import Fault
-from dataclasses import dataclass
-from flask import Flask, request, render_template, session, redirect
+from dataclasses import dataclass, field
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import count
+from flask import (
+    Flask,
+    request,
+    make_response,
+    render_template,
+    session,
+    redirect,
+)
 from flask_session import Session
 from cachelib.file import FileSystemCache
-from requests import get
+from requests import Session as HTTPSession
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+from urllib3.util.retry import Retry
 from argparse import ArgumentParser
+from bisect import bisect_right
+from pathlib import Path
+from waitress import serve
+import hashlib
+import html
 import os
+import secrets
 import sqlite3
+import time
+import traceback
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 from tm_mapselect.tmcolors import word_to_clean_text, word_to_html
 
@@ -30,22 +58,27 @@ class MapUserData:
     )
 
     @classmethod
-    def from_record(cls, record: int, medals: dict[str, int]) -> Self:
-        data = cls(record, None)
-        if record < medals["Bronze"]:
-            data.medal = "Bronze"
-        if record < medals["Silver"]:
-            data.medal = "Silver"
-        if record < medals["Gold"]:
-            data.medal = "Gold"
-        if record < medals["Author"]:
-            data.medal = "Author"
-        return data
+    def from_record(
+        cls, record: int, medal_times: tuple[int, ...], medal_names: tuple[str, ...]
+    ) -> Self:
+        # medal_times is sorted, the first time beaten by record is the best medal
+        index = bisect_right(medal_times, record)
+        if index < len(medal_names):
+            return cls(record, cast(Any, medal_names[index]))
+        return cls(record, None)
 
 
-@dataclass
+def _format_name(name: str) -> tuple[str, str]:
+    try:
+        return word_to_html(name), word_to_clean_text(name)
+    except ValueError:
+        # Unsupported style code, one odd name must not break the map list
+        return html.escape(name), name
+
+
+@dataclass(slots=True, frozen=True)
 class Map:
-    ID: int
+    ID: Optional[int]
     OnlineID: str
     UId: str
     Name: str
@@ -57,17 +90,35 @@ class Map:
     CopperPrice: int
     MapType: str
     MapStyle: str
-    Medals: dict[str, int]
+    Medals: dict[str, int] = field(hash=False)
+    Name_html: str = field(init=False, repr=False, compare=False)
+    Name_clean: str = field(init=False, repr=False, compare=False)
+    Author_clean: str = field(init=False, repr=False, compare=False)
+    MedalTimes: tuple[int, ...] = field(init=False, repr=False, compare=False)
+    MedalNames: tuple[str, ...] = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        # Rendered once per map instead of on every page load
+        name_html, name_clean = _format_name(self.Name)
+        object.__setattr__(self, "Name_html", name_html)
+        object.__setattr__(self, "Name_clean", name_clean)
+        object.__setattr__(self, "Author_clean", _format_name(self.Author)[1])
+        thresholds = sorted((time, name) for name, time in self.Medals.items())
+        object.__setattr__(self, "MedalTimes", tuple(t for t, _ in thresholds))
+        object.__setattr__(self, "MedalNames", tuple(n for _, n in thresholds))
 
 
 @dataclass
 class ModeScriptSettings:
     time_limit: int
+    _as_dict_cache: dict[str, int] = field(
+        default_factory=dict, init=False, repr=False, compare=False
+    )
 
     def as_dict(self) -> dict[str, int]:
-        return {
-            "S_TimeLimit": self.time_limit,
-        }
+        # Updated in place, callers must not mutate the returned dict
+        self._as_dict_cache["S_TimeLimit"] = self.time_limit
+        return self._as_dict_cache
 
     def update_from_dict(self, settings: dict[str, str | bool | int]) -> None:
         if "S_TimeLimit" in settings:
@@ -79,7 +130,7 @@ class ModeScriptSettings:
         return cls(time_limit=time_limit)
 
 
-@dataclass
+@dataclass(slots=True)
 class ServerState:
     server_name: str
     maps: list[Map]
@@ -87,6 +138,7 @@ class ServerState:
     current_map_index: int
     modescript_settings: ModeScriptSettings
     max_players: int
+    online_id_index: dict[str, Map] = field(default_factory=dict)
 
     @property
     def current_map(self) -> Map | None:
@@ -107,13 +159,21 @@ def validate_connection[T, **P](
     return wrapper
 
 
-def check_cast[T](obj: Any, typ: type[T]) -> T:
-    if not isinstance(obj, typ):
-        raise TypeError(f"Expected type {typ}, got {type(obj)}")
-    return cast(T, obj)
+if __debug__:
 
+    def check_cast[T](obj: Any, typ: type[T]) -> T:
+        if not isinstance(obj, typ):
+            raise TypeError(f"Expected type {typ}, got {type(obj)}")
+        return cast(T, obj)
 
-@dataclass
+else:
+    # Server responses are trusted when running with -O
+
+    def check_cast[T](obj: Any, typ: type[T]) -> T:
+        return cast(T, obj)
+
+
+@dataclass(slots=True)
 class DBEntry:
     uid: str
     id: int
@@ -139,48 +199,136 @@ class DBEntry:
 
         cursor.execute(f"CREATE TABLE IF NOT EXISTS map_uid_to_id ({rows})")
 
-    def insert_or_replace(self, cursor) -> None:
-        self_tuple = tuple(value for value in self.__dict__.values())
-        entry_strings = ", ".join("?" for _ in self_tuple)
-        field_names = ", ".join(self.__dict__.keys())
+    @classmethod
+    def from_tmx_result(cls, uid: str, result: dict[str, Any]) -> "DBEntry":
+        medals = result["Medals"]
+        authors = result.get("Authors", [])
+        return cls(
+            uid=uid,
+            id=result["MapId"],
+            online_id=result["OnlineMapId"],
+            author_name=authors[0]["User"]["Name"] if authors else "Unknown",
+            author_medal=medals.get("Author", 0),
+            gold_medal=medals.get("Gold", 0),
+            silver_medal=medals.get("Silver", 0),
+            bronze_medal=medals.get("Bronze", 0),
+        )
 
-        return cursor.execute(
-            f"INSERT OR REPLACE INTO map_uid_to_id ({field_names}) VALUES ({entry_strings})",
-            self_tuple,
+    def as_row(self) -> tuple[str | int, ...]:
+        return (
+            self.uid,
+            self.id,
+            self.online_id,
+            self.author_name,
+            self.author_medal,
+            self.gold_medal,
+            self.silver_medal,
+            self.bronze_medal,
         )
 
+    def insert_or_replace(self, cursor) -> None:
+        return cursor.execute(_INSERT_SQL, self.as_row())
+
+    @classmethod
+    def insert_or_replace_many(cls, cursor, entries: list["DBEntry"]) -> None:
+        cursor.executemany(_INSERT_SQL, [entry.as_row() for entry in entries])
+
     @classmethod
     def select_all(cls, cursor) -> list["DBEntry"]:
-        cursor.execute("SELECT * FROM map_uid_to_id")
+        cursor.execute(_SELECT_SQL)
         rows = cursor.fetchall()
         return [cls(*row) for row in rows]
 
+    @classmethod
+    def select_many(cls, cursor, uids: list[str]) -> list["DBEntry"]:
+        entries = []
+        # Stay below SQLite's host parameter limit
+        for i in range(0, len(uids), 500):
+            chunk = uids[i : i + 500]
+            placeholders = ", ".join("?" * len(chunk))
+            cursor.execute(f"{_SELECT_SQL} WHERE uid IN ({placeholders})", chunk)
+            entries += [cls(*row) for row in cursor.fetchall()]
+        return entries
+
+
+_DB_COLUMNS = (
+    "uid, id, online_id, author_name, "
+    "author_medal, gold_medal, silver_medal, bronze_medal"
+)
+_INSERT_SQL = (
+    f"INSERT OR REPLACE INTO map_uid_to_id ({_DB_COLUMNS}) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+)
+_SELECT_SQL = f"SELECT {_DB_COLUMNS} FROM map_uid_to_id"
+
 
 class DB:
     def __init__(self, db_path: str) -> None:
-        self.conn = sqlite3.connect(db_path)
+        # Autocommit mode, write transactions are started explicitly
+        self.conn = sqlite3.connect(
+            db_path, check_same_thread=False, isolation_level=None
+        )
+        self._write_lock = Lock()
         self._initialize_db()
+        # Separate connection so reads never wait on the writer
+        self.read_conn = sqlite3.connect(
+            f"{Path(db_path).absolute().as_uri()}?mode=ro",
+            uri=True,
+            check_same_thread=False,
+        )
 
     def _initialize_db(self) -> None:
         cursor = self.conn.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA busy_timeout=5000")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA cache_size=-64000")
+        cursor.execute("PRAGMA mmap_size=268435456")
         DBEntry.create_table_sql(cursor)
-        self.conn.commit()
+
+    @contextmanager
+    def _write_transaction(self) -> Iterator[sqlite3.Cursor]:
+        with self._write_lock:
+            cursor = self.conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                yield cursor
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+            cursor.execute("COMMIT")
 
     def db_add_entry(self, entry: DBEntry) -> None:
-        cursor = self.conn.cursor()
-        entry.insert_or_replace(cursor)
-        self.conn.commit()
+        with self._write_transaction() as cursor:
+            entry.insert_or_replace(cursor)
+
+    def db_add_entries(self, entries: list[DBEntry]) -> None:
+        if not entries:
+            return
+        with self._write_transaction() as cursor:
+            DBEntry.insert_or_replace_many(cursor, entries)
+
+    def optimize(self) -> None:
+        with self._write_lock:
+            self.conn.execute("PRAGMA optimize")
 
     def get_all_entries(self) -> dict[str, DBEntry]:
-        cursor = self.conn.cursor()
+        cursor = self.read_conn.cursor()
         entries = DBEntry.select_all(cursor)
         return {e.uid: e for e in entries}
 
+    def get_entries(self, uids: list[str]) -> dict[str, DBEntry]:
+        cursor = self.read_conn.cursor()
+        entries = DBEntry.select_many(cursor, uids)
+        return {e.uid: e for e in entries}
+
 
 class NadeoAPI:
     LOGIN_URL = "https://api.trackmania.com/oauth/authorize"
     TOKEN_URL = "https://api.trackmania.com/api/access_token"
     API_BASE_URL = "https://api.trackmania.com/"
+    TOKEN_FIELDS = ("access_token", "refresh_token", "token_type", "expires_at")
 
     def __init__(
         self,
@@ -191,28 +339,88 @@ class NadeoAPI:
         self.client_id = client_id
         self.client_secret = client_secret
         self.redirect_uri = redirect_uri
-        # self.session: OAuth2Session = OAuth2Session(
-        #     client_id, redirect_uri=redirect_uri
-        # )
+        self._auth_session = self._mount_pool(
+            OAuth2Session(
+                client_id, redirect_uri=redirect_uri, scope=["read_favorite"]
+            )
+        )
+        self._token_sessions: dict[str, OAuth2Session] = {}
+        self._token_sessions_lock = Lock()
+        self._refresh_executor = ThreadPoolExecutor(max_workers=2)
+        self._refreshing: set[str] = set()
+
+    @staticmethod
+    def _trim_token(token: dict[str, Any]) -> dict[str, Any]:
+        # Only keep what OAuth2Session needs, this ends up in the user session
+        return {key: token[key] for key in NadeoAPI.TOKEN_FIELDS if key in token}
+
+    @staticmethod
+    def _mount_pool(session: OAuth2Session) -> OAuth2Session:
+        session.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=20))
+        return session
+
+    def _session_for(self, token: dict[str, Any]) -> OAuth2Session:
+        key = token["access_token"]
+        with self._token_sessions_lock:
+            session = self._token_sessions.get(key)
+            if session is None:
+                if len(self._token_sessions) >= 64:
+                    # Drop the oldest session, dicts keep insertion order
+                    del self._token_sessions[next(iter(self._token_sessions))]
+                session = self._mount_pool(OAuth2Session(self.client_id, token=token))
+                self._token_sessions[key] = session
+            return session
 
     def refresh_token(self, token: dict[str, Any]) -> dict[str, Any]:
-        session = OAuth2Session(
-            self.client_id,
-            token=token,
-        )
-        new_token = session.refresh_token(
-            token_url=self.TOKEN_URL,
-            client_id=self.client_id,
-            client_secret=self.client_secret,
+        session = self._session_for(token)
+        new_token = self._trim_token(
+            session.refresh_token(
+                token_url=self.TOKEN_URL,
+                client_id=self.client_id,
+                client_secret=self.client_secret,
+            )
         )
+        with self._token_sessions_lock:
+            self._token_sessions.pop(token["access_token"], None)
+            self._token_sessions[new_token["access_token"]] = session
         return new_token
 
+    @staticmethod
+    def expires_soon(token: dict[str, Any], margin: int = 300) -> bool:
+        return token.get("expires_at", float("inf")) - time.time() < margin
+
+    def schedule_refresh(
+        self,
+        token: dict[str, Any],
+        on_refreshed: Callable[[dict[str, Any] | None], None],
+    ) -> None:
+        # on_refreshed gets the new token, or None if the refresh failed
+        key = token["access_token"]
+        with self._token_sessions_lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def refresh() -> None:
+            try:
+                try:
+                    new_token = self.refresh_token(token)
+                except Exception as e:
+                    print(f"Background token refresh failed: {e}")
+                    new_token = None
+                on_refreshed(new_token)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                with self._token_sessions_lock:
+                    self._refreshing.discard(key)
+
+        self._refresh_executor.submit(refresh)
+
     def get_authorization_url(self) -> str:
-        session = OAuth2Session(
-            self.client_id, redirect_uri=self.redirect_uri, scope=["read_favorite"]
+        authorization_url, state = self._auth_session.authorization_url(
+            self.LOGIN_URL
         )
-
-        authorization_url, state = session.authorization_url(self.LOGIN_URL)
         return authorization_url
 
     def get_token(self, code: str) -> dict[str, Any]:
@@ -222,56 +430,51 @@ class NadeoAPI:
             code=code,
             client_secret=self.client_secret,
         )
-        return token
+        return self._trim_token(token)
 
     def get_user(self, token: dict[str, Any]) -> dict[str, Any]:
-        session = OAuth2Session(
-            self.client_id,
-            token=token,
-        )
+        session = self._session_for(token)
         response = session.get(f"{self.API_BASE_URL}api/user")
         response.raise_for_status()
         return response.json()
 
     def get_records(
-        self, token: dict[str, Any], maps: list[Map]
+        self, token: dict[str, Any], maps_by_online_id: dict[str, Map]
     ) -> dict[str, MapUserData]:
-        session = OAuth2Session(
-            self.client_id,
-            token=token,
-        )
+        session = self._session_for(token)
 
-        dict_of_maps = {m.OnlineID: m for m in maps}
         records: dict[str, MapUserData] = {}
-        chunked_maps = [maps[i : i + 20] for i in range(0, len(maps), 20)]
-        for chunk in chunked_maps:
+        online_ids = list(maps_by_online_id)
+        chunked_ids = [online_ids[i : i + 20] for i in range(0, len(online_ids), 20)]
+
+        def fetch_chunk(chunk: list[str]) -> list[dict[str, Any]]:
             response = session.get(
                 f"{self.API_BASE_URL}api/user/map-records",
-                params={"mapId[]": map(lambda m: m.OnlineID, chunk)},
+                params=[("mapId[]", online_id) for online_id in chunk],
             )
             response.raise_for_status()
-            records |= {
-                record["mapId"]: MapUserData.from_record(
-                    record["time"], dict_of_maps[record["mapId"]].Medals
-                )
-                for record in response.json()
-            }
+            return json_loads(response.content)
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            for chunk_records in executor.map(fetch_chunk, chunked_ids):
+                records |= {
+                    record["mapId"]: MapUserData.from_record(
+                        record["time"],
+                        maps_by_online_id[record["mapId"]].MedalTimes,
+                        maps_by_online_id[record["mapId"]].MedalNames,
+                    )
+                    for record in chunk_records
+                }
         return records
 
     def get_favorite_maps(self, token: dict[str, Any]) -> dict[str, Any]:
-        session = OAuth2Session(
-            self.client_id,
-            token=token,
-        )
+        session = self._session_for(token)
         response = session.get(f"{self.API_BASE_URL}api/user/maps/favorite")
         response.raise_for_status()
-        return response.json()
+        return json_loads(response.content)
 
     def get_account_ids(self, token: dict[str, Any]) -> dict[str, Any]:
-        session = OAuth2Session(
-            self.client_id,
-            token=token,
-        )
+        session = self._session_for(token)
         response = session.get(
             f"{self.API_BASE_URL}api/display-names/account-ids",
             params={"displayName[]": "christ.of.steel"},
@@ -281,6 +484,9 @@ class NadeoAPI:
 
 
 class ServerController:
+    # Maps unknown to TMX are only looked up again after this many seconds
+    TMX_MISS_TTL = 60 * 60
+
     def __init__(
         self,
         host: str,
@@ -298,29 +504,110 @@ class ServerController:
             apiVersion="2022-03-21",
         )
         self.state: Optional[ServerState] = None
-        self._uid_to_id_cache: dict[str, DBEntry] = {}
+        self.state_version: int = 0
+        self._state_versions = count(1)
+        self._db = DB(sqlite_cache_path)
+        self._uid_to_id_cache: dict[str, DBEntry] = self._db.get_all_entries()
+        self._tmx_misses: dict[str, float] = {}
+        self._maps_by_uid: dict[str, Map] = {}
+        self._settings_dirty: bool = True
+        self._map_uids: tuple[str, ...] = ()
+        self._map_list: list[Map] = []
         self.update_thread: Thread = Thread(target=self._periodic_update, daemon=True)
         self.update_event: Event = Event()
-        self.sqlite_cache_path = sqlite_cache_path
+        self.work_thread: Thread = Thread(target=self._process_work, daemon=True)
+        self._work_queue: Queue[Callable[[], None]] = Queue()
+        self._pending_tasks: set[Callable[[], None]] = set()
+        self._pending_tasks_lock = Lock()
+        self._http = HTTPSession()
+        self._http.mount(
+            "https://",
+            HTTPAdapter(
+                pool_connections=16,
+                pool_maxsize=16,
+                max_retries=Retry(
+                    total=3,
+                    backoff_factor=0.2,
+                    status_forcelist=[429, 500, 502, 503, 504],
+                    # Hand the last response back instead of raising RetryError
+                    raise_on_status=False,
+                ),
+            ),
+        )
+        self._http.headers["Accept-Encoding"] = "gzip"
+        self._http.headers["User-Agent"] = "tm_mapselect"
 
     def _periodic_update(self) -> None:
-        self._db = DB(self.sqlite_cache_path)
-        self._uid_to_id_cache = self._db.get_all_entries()
+        last_optimize = time.monotonic()
         while True:
-            # try:
-            self.update_state()
-            # except Exception as e:
-            # print(f"Error during periodic update: {e}")
-            self.update_event.wait(timeout=60)
+            if time.monotonic() - last_optimize >= 15 * 60:
+                self._db.optimize()
+                last_optimize = time.monotonic()
+            # Refreshes all run on the work thread, get_map_list is not re-entrant
+            self.submit(self.update_state)
+            # Server callbacks keep the state fresh, this is only a safety re-sync
+            self.update_event.wait(timeout=10 * 60)
             self.update_event.clear()  # Race condition, but I don't care
 
+    def _process_work(self) -> None:
+        while True:
+            task = self._work_queue.get()
+            with self._pending_tasks_lock:
+                self._pending_tasks.discard(task)
+            try:
+                task()
+            except Exception as e:
+                print(f"Error during queued task: {e}")
+                traceback.print_exc()
+            finally:
+                self._work_queue.task_done()
+
+    def _bump_state_version(self) -> None:
+        self.state_version = next(self._state_versions)
+
+    def submit(self, task: Callable[[], None]) -> None:
+        # Bursts of callbacks queue the same update many times, an update that
+        # is still waiting in the queue will fetch the latest state anyway
+        with self._pending_tasks_lock:
+            if task in self._pending_tasks:
+                return
+            self._pending_tasks.add(task)
+        self._work_queue.put(task)
+
+    def _register_callbacks(self) -> None:
+        # Callbacks run on the receive loop of the remote, so they must not
+        # block on XML-RPC calls themselves
+        def on_event(task: Callable[[], None]) -> Callable[..., None]:
+            return lambda *_: self.submit(task)
+
+        def on_begin_map(*_) -> None:
+            # A new map may load different match settings
+            self._settings_dirty = True
+            self.submit(self.update_current_map_index)
+            self.submit(self.update_mode_script_settings)
+
+        self.remote.registerCallback("ManiaPlanet.BeginMap", on_begin_map)
+        self.remote.registerCallback(
+            "ManiaPlanet.MapListModified", on_event(self.update_map_list)
+        )
+        for method in (
+            "ManiaPlanet.PlayerConnect",
+            "ManiaPlanet.PlayerDisconnect",
+            "ManiaPlanet.PlayerInfoChanged",
+        ):
+            self.remote.registerCallback(method, on_event(self.update_player_list))
+
     @validate_connection
     def get_server_name(self) -> str:
         return check_cast(self.remote.call("GetServerName"), str)
 
     @validate_connection
     def get_max_players(self) -> int:
-        result = check_cast(self.remote.call("GetMaxPlayers"), dict)
+        return self._parse_max_players(self.remote.call("GetMaxPlayers"))
+
+    @staticmethod
+    def _parse_max_players(result: Any) -> int:
+        result = check_cast(result, dict)
         if "CurrentValue" not in result:
             raise RuntimeError("Failed to get max players.")
         return check_cast(result["CurrentValue"], int)
@@ -328,39 +615,69 @@ class ServerController:
     @validate_connection
     def set_max_players(self, max_players: int) -> None:
         try:
-            self.remote.call("SetMaxPlayers", max_players)
+            result = self.remote.call("SetMaxPlayers", max_players)
         except Fault as e:
             raise RuntimeError(f"Failed to set max players: {e}") from e
+        if isinstance(result, Fault):
+            raise RuntimeError(f"Failed to set max players: {result}")
+        if self.state:
+            self.state.max_players = max_players
+            self._bump_state_version()
 
     @validate_connection
     def get_player_list(self) -> list[str]:
-        players = self.remote.call("GetPlayerList", 100, 0)
+        return self._parse_player_list(self.remote.call("GetPlayerList", 100, 0))
+
+    @staticmethod
+    def _parse_player_list(players: Any) -> list[str]:
         if not isinstance(players, list) or len(players) == 0:
             raise RuntimeError("Failed to get player list.")
         players = players[1:]
         return [check_cast(player["NickName"], str) for player in players]
 
+    @validate_connection
+    def multicall(self, *calls: tuple[Any, ...]) -> list[Any]:
+        results = self.remote.multicall(*calls)
+        if not isinstance(results, list) or len(results) != len(calls):
+            raise RuntimeError("Failed to perform multicall.")
+        values = []
+        for call, result in zip(calls, results):
+            if isinstance(result, dict) and "faultCode" in result:
+                raise RuntimeError(f"{call[0]} failed: {result['faultString']}")
+            values.append(result[0])
+        return values
+
     def connect(self) -> bool:
         print("Connecting to the dedicated server...")
         connected = self.remote.connect()
         if connected:
             maps = []
-            current_map_index = self.get_current_map_index()
-            mode_script_settings = ModeScriptSettings.from_dict(
-                self.get_mode_script_settings()
+            (
+                current_map_index,
+                mode_script_settings,
+                server_name,
+                max_players,
+                player_list,
+            ) = self.multicall(
+                ("GetCurrentMapIndex",),
+                ("GetModeScriptSettings",),
+                ("GetServerName",),
+                ("GetMaxPlayers",),
+                ("GetPlayerList", 100, 0),
             )
-            server_name = self.get_server_name()
-            max_players = self.get_max_players()
-            player_list = self.get_player_list()
             self.state = ServerState(
-                server_name=server_name,
+                server_name=check_cast(server_name, str),
                 maps=maps,
-                players=player_list,
-                current_map_index=current_map_index,
-                modescript_settings=mode_script_settings,
-                max_players=max_players,
+                players=self._parse_player_list(player_list),
+                current_map_index=check_cast(current_map_index, int),
+                modescript_settings=ModeScriptSettings.from_dict(
+                    check_cast(mode_script_settings, dict)
+                ),
+                max_players=self._parse_max_players(max_players),
             )
+            self._register_callbacks()
             self.update_thread.start()
+            self.work_thread.start()
         return connected
 
     @validate_connection
@@ -372,114 +689,280 @@ class ServerController:
         self, settings_dict: dict[str, bool | int | str]
     ) -> bool:
         try:
-            current_mode_settings = self.get_mode_script_settings()
-            current_mode_settings |= settings_dict
-            result = self.remote.call("SetModeScriptSettings", current_mode_settings)
+            result = self.remote.call("SetModeScriptSettings", settings_dict)
+            if isinstance(result, Fault):
+                # Fall back to sending the complete settings if the server
+                # rejects the partial update
+                current_mode_settings = self.get_mode_script_settings()
+                current_mode_settings |= settings_dict
+                result = self.remote.call(
+                    "SetModeScriptSettings", current_mode_settings
+                )
             if not isinstance(result, bool):
                 raise RuntimeError("Failed to set mode script settings.")
         except Fault as e:
             raise RuntimeError(f"Failed to set mode script setting: {e}") from e
+        if result and self.state:
+            # The server accepted the values, no need to read them back
+            self.state.modescript_settings.update_from_dict(settings_dict)
+            self._bump_state_version()
         return result
 
     def disconnect(self) -> None:
         self.remote.stop()
+        self._http.close()
 
     @validate_connection
     def get_current_map_index(self) -> int:
         return check_cast(self.remote.call("GetCurrentMapIndex"), int)
 
-    def get_tmx_ids(self, map_uid: str) -> DBEntry:
-        if map_uid in self._uid_to_id_cache:
-            return self._uid_to_id_cache[map_uid]
-        response = get(
-            f"https://trackmania.exchange/api/maps?uid={map_uid}",
+    def _record_tmx_miss(self, map_uid: str) -> None:
+        print(f"No TMX info for map UID {map_uid}, retrying in {self.TMX_MISS_TTL}s.")
+        self._tmx_misses[map_uid] = time.monotonic() + self.TMX_MISS_TTL
+
+    def _fetch_tmx_ids(self, map_uid: str) -> Optional[DBEntry]:
+        try:
+            response = self._http.get(
+                f"https://trackmania.exchange/api/maps?uid={map_uid}",
+                params={
+                    "fields": "MapId,OnlineMapId,Medals.Author,Medals.Gold,Medals.Silver,Medals.Bronze,Authors[]"
+                },
+                timeout=5,
+            )
+            if response.status_code != 200:
+                self._record_tmx_miss(map_uid)
+                return None
+            results = json_loads(response.content)["Results"]
+        except (RequestException, ValueError, KeyError) as e:
+            print(f"TMX lookup for map UID {map_uid} failed: {e}")
+            self._record_tmx_miss(map_uid)
+            return None
+
+        if not results:
+            self._record_tmx_miss(map_uid)
+            return None
+        entry = DBEntry.from_tmx_result(map_uid, results[0])
+        self._uid_to_id_cache[map_uid] = entry
+
+        return entry
+
+    def _fetch_tmx_ids_bulk(self, map_uids: list[str]) -> list[DBEntry]:
+        response = self._http.get(
+            "https://trackmania.exchange/api/maps",
             params={
-                "fields": "MapId,OnlineMapId,Medals.Author,Medals.Gold,Medals.Silver,Medals.Bronze,Authors[]"
+                "uid": ",".join(map_uids),
+                "count": len(map_uids),
+                "fields": "MapId,MapUid,OnlineMapId,Medals.Author,Medals.Gold,Medals.Silver,Medals.Bronze,Authors[]",
             },
+            timeout=5,
         )
         if response.status_code != 200:
-            raise RuntimeError(f"Failed to retrieve TMX info for map UID {map_uid}.")
-
-        id = response.json()["Results"][0]["MapId"]
-        online_map_id = response.json()["Results"][0]["OnlineMapId"]
-        medals = response.json()["Results"][0]["Medals"]
-        authors = response.json()["Results"][0].get("Authors", [])
-        author_name = authors[0]["User"]["Name"] if authors else "Unknown"
-
-        entry = DBEntry(
-            uid=map_uid,
-            id=id,
-            online_id=online_map_id,
-            author_name=author_name,
-            author_medal=medals.get("Author", 0),
-            gold_medal=medals.get("Gold", 0),
-            silver_medal=medals.get("Silver", 0),
-            bronze_medal=medals.get("Bronze", 0),
-        )
-        self._uid_to_id_cache[map_uid] = entry
-        self._db.db_add_entry(entry)
+            raise RuntimeError(
+                f"Failed to retrieve TMX info for map UIDs {', '.join(map_uids)}."
+            )
 
-        return entry
+        entries = []
+        for result in json_loads(response.content)["Results"]:
+            entry = DBEntry.from_tmx_result(result["MapUid"], result)
+            self._uid_to_id_cache[entry.uid] = entry
+            entries.append(entry)
+        for map_uid in map_uids:
+            if map_uid not in self._uid_to_id_cache:
+                self._record_tmx_miss(map_uid)
 
-    @validate_connection
-    def get_map_list(self, map_chunks: int = 5) -> list[Map]:
+        return entries
+
+    def _fetch_tmx_chunk(self, map_uids: list[str]) -> list[DBEntry]:
+        try:
+            return self._fetch_tmx_ids_bulk(map_uids)
+        except (RequestException, RuntimeError, ValueError, KeyError) as e:
+            print(f"Bulk TMX lookup failed, falling back to single lookups: {e}")
+            entries = []
+            for map_uid in map_uids:
+                entry = self._fetch_tmx_ids(map_uid)
+                if entry is not None:
+                    entries.append(entry)
+            return entries
+
+    @staticmethod
+    def _is_end_of_map_list(fault_string: str) -> bool:
+        # Requesting a page past the last map is a fault, not an empty list
+        return "out of bound" in fault_string.lower()
+
+    def _get_map_list_page(
+        self, map_chunks: int, offset: int
+    ) -> tuple[list[dict[str, Any]], int]:
+        while True:
+            page = self.remote.call("GetMapList", map_chunks, offset)
+            if isinstance(page, list):
+                return page, map_chunks
+            if isinstance(page, Fault) and self._is_end_of_map_list(page.faultString):
+                return [], map_chunks
+            if map_chunks <= 10:
+                raise RuntimeError(
+                    f"Failed to get the map list at offset {offset}: {page}"
+                )
+            # Most likely the response exceeded the server's size limit
+            map_chunks = max(map_chunks // 2, 10)
+
+    def _get_raw_map_list(self, map_chunks: int) -> list[dict[str, Any]]:
+        maps: list[dict[str, Any]] = []
         offset = 0
-        maps = []
-        new_maps = self.remote.call("GetMapList", map_chunks, offset)
-        if not isinstance(new_maps, list):
-            return []
-        maps += new_maps
-        offset += map_chunks
-        while len(new_maps) >= map_chunks:
-            new_maps = self.remote.call("GetMapList", map_chunks, offset)
-            if not isinstance(new_maps, list):
-                break
-            maps += new_maps
-            offset += map_chunks
-        for map_data in maps:
-            entry = self.get_tmx_ids(map_data["UId"])
-            map_data["ID"] = entry.id
-            map_data["OnlineID"] = entry.online_id
-            map_data["Medals"] = {
-                "Author": entry.author_medal,
-                "Gold": entry.gold_medal,
-                "Silver": entry.silver_medal,
-                "Bronze": entry.bronze_medal,
-            }
-            map_data["Author"] = entry.author_name
-
-        return [Map(**map_data) for map_data in maps]
+        batched = True
+        while True:
+            page, map_chunks = self._get_map_list_page(map_chunks, offset)
+            maps.extend(page)
+            offset += len(page)
+            if len(page) < map_chunks:
+                return maps
+            if not batched:
+                continue
+            # Request the next pages in a single round trip
+            pages = self.remote.multicall(
+                *(
+                    ("GetMapList", map_chunks, offset + i * map_chunks)
+                    for i in range(10)
+                )
+            )
+            if not isinstance(pages, list):
+                # The combined response is too large, go on page by page
+                batched = False
+                continue
+            for result in pages:
+                if not isinstance(result, list):
+                    if isinstance(result, dict) and self._is_end_of_map_list(
+                        result.get("faultString", "")
+                    ):
+                        return maps
+                    # Continue with single pages from here, they can shrink
+                    break
+                page = check_cast(result[0], list)
+                maps.extend(page)
+                offset += len(page)
+                if len(page) < map_chunks:
+                    return maps
+
+    @validate_connection
+    def get_map_list(self, map_chunks: int = 1000) -> list[Map]:
+        maps = self._get_raw_map_list(map_chunks)
+
+        map_uids = tuple(map_data["UId"] for map_data in maps)
+        now = time.monotonic()
+        expired = [uid for uid, expires in self._tmx_misses.items() if expires <= now]
+        for map_uid in expired:
+            # Rebuild these maps so the lookup is tried again
+            del self._tmx_misses[map_uid]
+            self._maps_by_uid.pop(map_uid, None)
+        if map_uids == self._map_uids and not expired:
+            return self._map_list
+
+        new_maps_data = [
+            map_data for map_data in maps if map_data["UId"] not in self._maps_by_uid
+        ]
+        missing = list(
+            dict.fromkeys(
+                map_data["UId"]
+                for map_data in new_maps_data
+                if map_data["UId"] not in self._uid_to_id_cache
+                and map_data["UId"] not in self._tmx_misses
+            )
+        )
+        if missing:
+            # Another process sharing the cache file might have fetched them already
+            self._uid_to_id_cache.update(self._db.get_entries(missing))
+            missing = [uid for uid in missing if uid not in self._uid_to_id_cache]
+        chunked_uids = [missing[i : i + 50] for i in range(0, len(missing), 50)]
+        new_entries = []
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            for entries in executor.map(self._fetch_tmx_chunk, chunked_uids):
+                new_entries += entries
+        self._db.db_add_entries(new_entries)
+
+        maps_by_uid = {}
+        for map_data in new_maps_data:
+            entry = self._uid_to_id_cache.get(map_data["UId"])
+            if entry is None:
+                # Not on TMX, keep the map with what the server knows about it
+                map_data["ID"] = None
+                map_data["OnlineID"] = ""
+                map_data["Medals"] = {}
+            else:
+                map_data["ID"] = entry.id
+                map_data["OnlineID"] = entry.online_id
+                map_data["Medals"] = {
+                    "Author": entry.author_medal,
+                    "Gold": entry.gold_medal,
+                    "Silver": entry.silver_medal,
+                    "Bronze": entry.bronze_medal,
+                }
+                map_data["Author"] = entry.author_name
+            maps_by_uid[map_data["UId"]] = Map(**map_data)
+
+        result = [
+            self._maps_by_uid.get(map_data["UId"]) or maps_by_uid[map_data["UId"]]
+            for map_data in maps
+        ]
+        self._maps_by_uid = {m.UId: m for m in result}
+        self._map_uids = map_uids
+        self._map_list = result
+        return result
 
     @validate_connection
     def set_current_map_index(self, index: int) -> None:
         try:
             print(f"Jumping to map index {index}...")
-            self.remote.call("JumpToMapIndex", index)
+            result = self.remote.call("JumpToMapIndex", index)
         except Fault as e:
             raise RuntimeError(f"Failed to set current map index: {e}") from e
+        if isinstance(result, Fault):
+            raise RuntimeError(f"Failed to set current map index: {result}")
 
     def update_map_list(self) -> None:
         if self.state:
-            self.state.maps = self.get_map_list()
+            maps = self.get_map_list()
+            if maps is not self.state.maps:
+                self.state.maps = maps
+                self.state.online_id_index = {m.OnlineID: m for m in maps if m.OnlineID}
+                self._bump_state_version()
 
     def update_current_map_index(self) -> None:
         if self.state:
             self.state.current_map_index = self.get_current_map_index()
+            self._bump_state_version()
 
     def update_mode_script_settings(self) -> None:
-        if self.state:
+        if self.state and self._settings_dirty:
+            self._settings_dirty = False
             settings = self.get_mode_script_settings()
             self.state.modescript_settings.update_from_dict(settings)
+            self._bump_state_version()
 
     def update_player_list(self) -> None:
         if self.state:
             self.state.players = self.get_player_list()
+            self._bump_state_version()
 
     def update_state(self) -> None:
-        self.update_map_list()
-        self.update_current_map_index()
-        self.update_mode_script_settings()
-        self.update_player_list()
+        # The map list refresh waits on TMX, fetch the rest in the meantime
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            map_list_update = executor.submit(self.update_map_list)
+            self._update_server_info()
+            map_list_update.result()
+
+    def _update_server_info(self) -> None:
+        if self.state:
+            self._settings_dirty = False
+            current_map_index, mode_script_settings, player_list = self.multicall(
+                ("GetCurrentMapIndex",),
+                ("GetModeScriptSettings",),
+                ("GetPlayerList", 100, 0),
+            )
+            self.state.current_map_index = check_cast(current_map_index, int)
+            self.state.modescript_settings.update_from_dict(
+                check_cast(mode_script_settings, dict)
+            )
+            self.state.players = self._parse_player_list(player_list)
+            self._bump_state_version()
 
 
 def create_app(
@@ -495,6 +978,7 @@ def create_app(
     )
     app.config["PERMANENT_SESSION_LIFETIME"] = 60 * 60 * 60 * 24 * 31
     Session(app)
+    token_store = app.config["SESSION_CACHELIB"]
 
     controller = ServerController(tm_server, tm_xml_port, tm_user, tm_password)
     controller.connect()
@@ -505,14 +989,7 @@ def create_app(
     )
 
     @app.template_filter()
-    def format_tm(word: str) -> str:
-        return word_to_html(word)
-
-    @app.template_filter()
-    def format_tm_clean(word: str) -> str:
-        return word_to_clean_text(word)
-
-    @app.template_filter()
+    @lru_cache(maxsize=4096)
     def format_time(ms: int) -> str:
         seconds = ms // 1000
         minutes = seconds // 60
@@ -520,52 +997,147 @@ def create_app(
         milliseconds = ms % 1000
         return f"{minutes:02}:{seconds:02}.{milliseconds:03}"
 
+    def render_index(
+        state: ServerState, user_name: str | None, records: dict[str, MapUserData]
+    ) -> str:
+        return render_template(
+            "index.html",
+            state=state,
+            current_map=state.current_map,
+            maps=tuple(enumerate(state.maps)),
+            authorization_url=nadeo_api.get_authorization_url(),
+            user_name=user_name,
+            records=records,
+        )
+
+    # State versions restart with every process, so tie ETags to this one
+    etag_prefix = secrets.token_hex(8)
+
+    def conditional_page(etag: str, render: Callable[[], str]):
+        etag = f"{etag_prefix}-{etag}"
+        # Skip rendering entirely if the browser already has this page
+        if request.if_none_match.contains_weak(etag):
+            response = make_response("", 304)
+        else:
+            response = make_response(render())
+        response.set_etag(etag, weak=True)
+        # Still revalidate every time, the page changes on login and logout
+        response.headers["Cache-Control"] = "private, no-cache"
+        return response
+
+    anonymous_index: tuple[int, str] | None = None
+
+    def use_refreshed_token() -> None:
+        # Tokens refreshed in the background are parked in the session store
+        # under the session id, so they outlive the process until the next visit
+        refresh_key = f"refreshed_token:{session.sid}"
+        token = session["token"]
+        refreshed = token_store.get(refresh_key)
+        if refreshed and refreshed["old"] == token["access_token"]:
+            # A failed refresh stays parked so it is not retried on every load,
+            # the TokenExpiredError fallback takes over once the token expires
+            if refreshed["token"]:
+                session["token"] = refreshed["token"]
+                session.permanent = True
+                token_store.delete(refresh_key)
+            return
+        if refreshed:
+            token_store.delete(refresh_key)
+        if not nadeo_api.expires_soon(token):
+            return
+
+        def store(new_token: dict[str, Any] | None) -> None:
+            token_store.set(
+                refresh_key,
+                {"old": token["access_token"], "token": new_token},
+                timeout=app.config["PERMANENT_SESSION_LIFETIME"],
+            )
+
+        nadeo_api.schedule_refresh(token, store)
+
     @app.route("/")
     def index():
         if not controller.state:
             return "<h1>Error: Not connected to the server.</h1>"
 
+        if "token" not in session:
+            # The anonymous page only changes with the server state
+            version = controller.state_version
+
+            def render_anonymous() -> str:
+                nonlocal anonymous_index
+                if anonymous_index is None or anonymous_index[0] != version:
+                    anonymous_index = (
+                        version,
+                        render_index(controller.state, None, {}),
+                    )
+                return anonymous_index[1]
+
+            return conditional_page(str(version), render_anonymous)
+
         records = {}
         if "token" in session:
+            use_refreshed_token()
             try:
-                records = nadeo_api.get_records(session["token"], controller.state.maps)
+                records = nadeo_api.get_records(
+                    session["token"], controller.state.online_id_index
+                )
             except TokenExpiredError:
                 print("Refreshing expired token...")
-                new_token = nadeo_api.refresh_token(session["token"])
-                session["token"] = new_token
+                session["token"] = nadeo_api.refresh_token(session["token"])
                 session.permanent = True
-                records = nadeo_api.get_records(session["token"], controller.state.maps)
+                records = nadeo_api.get_records(
+                    session["token"], controller.state.online_id_index
+                )
 
-        return render_template(
-            "index.html",
-            state=controller.state,
-            authorization_url=nadeo_api.get_authorization_url(),
-            user_name=session.get("displayName", None),
-            records=records,
+        state = controller.state
+        user_name = session.get("displayName", None)
+        fingerprint = hashlib.md5(
+            repr(
+                (
+                    controller.state_version,
+                    user_name,
+                    sorted((k, v.record, v.medal) for k, v in records.items()),
+                )
+            ).encode()
+        ).hexdigest()
+        return conditional_page(
+            fingerprint, lambda: render_index(state, user_name, records)
         )
 
     @app.route("/jumpToMap/<int:map_index>")
     def jump_to_map(map_index: int):
-        try:
+        # Catch obvious mistakes here, the queued task can only log its errors
+        if not controller.state:
+            return "<h1>Error: Not connected to the server.</h1>", 503
+        if not 0 <= map_index < len(controller.state.maps):
+            return f"Error: No map with index {map_index}. <a href='/'>Go back</a>", 404
+
+        def task() -> None:
             controller.set_current_map_index(map_index)
-            controller.update_event.set()
-            return f"Jumped to map index {map_index}. <a href='/'>Go back</a>"
-        except RuntimeError as e:
-            return f"Error: {e}. <a href='/'>Go back</a>"
+            controller.update_current_map_index()
+
+        controller.submit(task)
+        return f"Jumping to map index {map_index}. <a href='/'>Go back</a>", 202
 
     @app.route("/settings", methods=["POST"])
     def update_settings():
         try:
             timelimit = int(request.form["time_limit"])
             max_players = int(request.form["max_players"])
+        except ValueError as e:
+            return f"Error: {e}", 400
+        if max_players < 0:
+            return "Error: max_players must not be negative.", 400
+
+        def task() -> None:
             result = controller.set_mode_script_settings({"S_TimeLimit": timelimit})
             if not result:
                 raise RuntimeError("Failed to set time limit.")
             controller.set_max_players(max_players)
-            controller.update_event.set()
-            return "OK"
-        except (ValueError, RuntimeError) as e:
-            return f"Error: {e}"
+
+        controller.submit(task)
+        return "OK", 202
 
     @app.route("/refresh")
     def refresh():
@@ -577,11 +1149,7 @@ def create_app(
         if not controller.state:
             return "<h1>Error: Not connected to the server.</h1>"
         settings = controller.state.modescript_settings
-        settings_list = "".join(
-            [f"<li>{key}: {value}</li>" for key, value in settings.as_dict().items()]
-        )
-
-        return f"<h1>Mode Script Settings</h1><ul>{settings_list}</ul><a href='/'>Go back</a>"
+        return render_template("settings.html", settings=settings.as_dict())
 
     @app.route("/.auth/callback")
     def auth_callback():
@@ -617,9 +1185,10 @@ def main():
     password = os.getenv("TM_PASSWORD", None)
     host = os.getenv("APP_HOST", "localhost")
     port = int(os.getenv("APP_PORT", "8080"))
+    threads = int(os.getenv("APP_THREADS", "8"))
     client_id = os.getenv("NADEO_CLIENT_ID", None)
     client_secret = os.getenv("NADEO_CLIENT_SECRET", None)
-    debug = os.getenv("APP_DEBUG", "1") == "1"
+    debug = os.getenv("APP_DEBUG", "0") == "1"
     redirect_uri = os.getenv(
         "NADEO_REDIRECT_URI", "http://localhost:8080/.auth/callback"
     )
@@ -666,6 +1235,13 @@ def main():
     arg_parser.add_argument(
         "--port", "-P", type=int, default=port, help="Bind port for the web server"
     )
+    arg_parser.add_argument(
+        "--threads",
+        "-t",
+        type=int,
+        default=threads,
+        help="Number of request threads of the web server",
+    )
     arg_parser.add_argument(
         "--client-id",
         "-c",
@@ -701,7 +1277,10 @@ def main():
         args.client_secret,
         args.redirect_uri,
     )
-    app.run(host=args.host, port=args.port, debug=debug)
+    if debug:
+        app.run(host=args.host, port=args.port, debug=True, threaded=True)
+    else:
+        serve(app, host=args.host, port=args.port, threads=args.threads)
 
 
 if __name__ == "__main__":
@@ -1,8 +1,10 @@
-from typing import Literal, Optional
+from typing import Callable, Literal, Optional, cast
 from dataclasses import dataclass
+from functools import lru_cache
+import re
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Style:
     bold: bool
     italic: bool
@@ -11,31 +13,34 @@ class Style:
     shadow: bool
     color: Optional[str]
 
-    def set_defaults(self):
-        self.bold = False
-        self.italic = False
-        self.width = "normal"
-        self.uppercase = False
-        self.shadow = False
-        self.color = None
-
     def to_css(self) -> str:
-        styles = []
-        if self.bold:
-            styles.append("font-weight: bold;")
-        if self.italic:
-            styles.append("font-style: italic;")
-        if self.width == "wide":
-            styles.append("font-stretch: expanded;")
-        elif self.width == "narrow":
-            styles.append("font-stretch: condensed;")
-        if self.uppercase:
-            styles.append("text-transform: uppercase;")
-        if self.shadow:
-            styles.append("text-shadow: 2px 2px 4px #000000;")
-        if self.color:
-            styles.append(f"color: #{self.color};")
-        return " ".join(styles)
+        return _style_css(self)
+
+
+# Names reuse a handful of styles, so the CSS is built once per style
+@lru_cache(maxsize=256)
+def _style_css(style: Style) -> str:
+    styles = []
+    if style.bold:
+        styles.append("font-weight: bold;")
+    if style.italic:
+        styles.append("font-style: italic;")
+    if style.width == "wide":
+        styles.append("font-stretch: expanded;")
+    elif style.width == "narrow":
+        styles.append("font-stretch: condensed;")
+    if style.uppercase:
+        styles.append("text-transform: uppercase;")
+    if style.shadow:
+        styles.append("text-shadow: 2px 2px 4px #000000;")
+    if style.color:
+        styles.append(f"color: #{style.color};")
+    return " ".join(styles)
+
+
+@lru_cache(maxsize=256)
+def _span_open(style: Style) -> str:
+    return f'<span style="{_style_css(style)}">'
 
 
 @dataclass
@@ -44,90 +49,83 @@ class Fragment:
     style: Style
 
     def to_html(self) -> str:
-        style_str = self.style.to_css()
-        return f'<span style="{style_str}">{self.text}</span>'
+        return f"{_span_open(self.style)}{self.text}</span>"
+
+
+StyleState = tuple[
+    bool, bool, Literal["normal", "wide", "narrow"], bool, bool, Optional[str]
+]
+
+_DEFAULT_STATE: StyleState = (False, False, "normal", False, False, None)
+
+
+def _set(index: int, value: object) -> Callable[[StyleState], StyleState]:
+    def op(state: StyleState) -> StyleState:
+        return cast(StyleState, state[:index] + (value,) + state[index + 1 :])
+
+    return op
+
+
+_STYLE_OPS: dict[str, Callable[[StyleState], StyleState]] = {
+    "o": _set(0, True),
+    "i": _set(1, True),
+    "w": _set(2, "wide"),
+    "n": _set(2, "narrow"),
+    "m": _set(2, "normal"),
+    "t": _set(3, True),
+    "s": _set(4, True),
+    "g": _set(5, None),
+    "z": lambda state: _DEFAULT_STATE,
+}
+# Style codes are case insensitive
+_STYLE_OPS.update({code.upper(): op for code, op in _STYLE_OPS.items()})
+
+_HEX = frozenset("0123456789ABCDEFabcdef")
+
+
+# Either a run of plain text or a single style code. A colour takes the
+# three characters after the "$", a lone "$" at the end yields an empty code.
+_TOKEN_RE = re.compile(r"([^$]+)|\$([0-9A-Fa-f].{0,2}|.?)", re.DOTALL)
 
 
 def parse_word(word: str) -> list[Fragment]:
     fragments = []
-    i = 0
-    current_style = Style(
-        bold=False,
-        italic=False,
-        width="normal",
-        uppercase=False,
-        shadow=False,
-        color=None,
-    )
-    last_style = Style(
-        bold=False,
-        italic=False,
-        width="normal",
-        uppercase=False,
-        shadow=False,
-        color=None,
-    )
-    current_str = ""
-
-    while i < len(word):
-        char = word[i]
-        next_char = word[i + 1] if i + 1 < len(word) else None
-
-        if char == "$":
-            i += 1
-            match next_char:
-                case "o" | "O":
-                    current_style.bold = True
-                case "i" | "I":
-                    current_style.italic = True
-                case "w" | "W":
-                    current_style.width = "wide"
-                case "n" | "N":
-                    current_style.width = "narrow"
-                case "m" | "M":
-                    current_style.width = "normal"
-                case "t" | "T":
-                    current_style.uppercase = True
-                case "s" | "S":
-                    current_style.shadow = True
-                case "g" | "G":
-                    current_style.color = None
-                case "z" | "Z":
-                    current_style.set_defaults()
-                case "$":
-                    current_str += "$"
-                case _ if next_char in "0123456789ABCDEFabcdef":
-                    hev_value = word[i : i + 3]
-                    i += 2
-                    current_style.color = hev_value
-                case _:
-                    raise ValueError(f"Unknown style code: {next_char}")
-            if current_style != last_style:
-                if current_str:
-                    fragments.append(Fragment(text=current_str, style=last_style))
-                    current_str = ""
-                last_style = Style(
-                    bold=current_style.bold,
-                    italic=current_style.italic,
-                    width=current_style.width,
-                    uppercase=current_style.uppercase,
-                    shadow=current_style.shadow,
-                    color=current_style.color,
-                )
+    state = last_state = _DEFAULT_STATE
+    buf: list[str] = []
+
+    for text, code in _TOKEN_RE.findall(word):
+        if text:
+            buf.append(text)
+            continue
+
+        op = _STYLE_OPS.get(code)
+        if op is not None:
+            state = op(state)
+        elif code == "$":
+            buf.append("$")
+        elif code and code[0] in _HEX:
+            state = state[:5] + (code,)
         else:
-            current_str += char
+            raise ValueError(f"Unknown style code: {code or None}")
+
+        if state != last_state:
+            if buf:
+                fragments.append(Fragment(text="".join(buf), style=Style(*last_state)))
+                buf.clear()
+            last_state = state
 
-        i += 1
-    if current_str:
-        fragments.append(Fragment(text=current_str, style=current_style))
+    if buf:
+        fragments.append(Fragment(text="".join(buf), style=Style(*state)))
     return fragments
 
 
+@lru_cache(maxsize=4096)
 def word_to_html(word: str) -> str:
     fragments = parse_word(word)
     return "".join(fragment.to_html() for fragment in fragments)
 
 
+@lru_cache(maxsize=4096)
 def word_to_clean_text(word: str) -> str:
     fragments = parse_word(word)
     return "".join(fragment.text for fragment in fragments)